@@ -1,6 +1,42 @@
+from array import array
+from collections import OrderedDict
 from functools import wraps
 
 
+# Every node lives in the parallel columns of a DiagramBuilder and is referred
+# to by an edge handle: the node's index shifted left by one, with the low bit
+# set when the edge is complemented. Node 0 is the single terminal, so the
+# handles 0 and 1 coincide with False and True. Terminals always sit below
+# every real variable.
+TERMINAL_VARIABLE = 2 ** 31 - 1
+# Variable column entry of a slot whose node has been garbage collected and
+# which is waiting on the free list to be reused.
+FREE_VARIABLE = -1
+# Unique table slots: never used, and used by a node that has since been
+# removed. Probes stop at the former but must carry on past the latter.
+EMPTY = -1
+DELETED = -2
+
+TERMINALS = (False, True)
+
+
+def _mentions(value, dead):
+    """Whether value, or anything in it if it is a tuple, could be a handle
+    to one of the node indices in dead. This is conservative: integers that
+    are not handles at all (such as bounds in a pseudo-boolean key) may match
+    too, which only costs a recomputation."""
+    if isinstance(value, tuple):
+        return any(_mentions(v, dead) for v in value)
+    return type(value) is int and value >= 2 and (value >> 1) in dead
+
+
+def node_hash(choice, iftrue, iffalse):
+    # Mixes the three columns of a node without allocating a tuple.
+    return (
+        choice * 12582917 + iftrue * 4256249 + iffalse * 741457
+    ) ^ (iftrue >> 7)
+
+
 def canonicalize(value):
     try:
         return tuple(map(canonicalize, value))
@@ -29,110 +65,722 @@ def cached(function):
     return accept
 
 
-class DiagramBuilder(object):
-    def __init__(self):
-        self.__cache = {}
-        self.__id_counter = 0
+# Rough number of bytes a single cache entry costs: two list slots, the key
+# tuple and the integers it holds. Only used to turn a memory budget into a
+# number of entries.
+CACHE_ENTRY_BYTES = 128
+# Rough number of extra bytes each (coefficient, term) pair adds to a cache
+# entry whose key holds a whole pseudo-boolean formula.
+FORMULA_TERM_BYTES = 128
+
+
+class ComputedCache(object):
+    """A lossy, direct-mapped cache of operation results.
+
+    Each key hashes to exactly one slot and storing a result simply
+    overwrites whatever was there before, so the cache never holds more than
+    max_capacity entries however many results are stored in it. The table
+    starts small and doubles as it fills up until it reaches max_capacity.
+    """
+
+    def __init__(self, max_capacity, capacity=1024):
+        assert max_capacity > 0 and max_capacity & (max_capacity - 1) == 0
+        capacity = min(capacity, max_capacity)
+        self.max_capacity = max_capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__size = 0
+        self.__keys = [None] * capacity
+        self.__values = [None] * capacity
+        self.__mask = capacity - 1
+
+    @classmethod
+    def for_budget(cls, budget):
+        """Returns a cache whose entries fit in roughly budget bytes."""
+        slots = max(1, budget // CACHE_ENTRY_BYTES)
+        max_capacity = 1
+        while max_capacity * 2 <= slots:
+            max_capacity *= 2
+        return cls(max_capacity)
 
-    def variable(self, i):
-        return self.bdd(i, True, False)
-
-    def bdd(self, choice, iftrue, iffalse):
-        key = ("bdd", choice, iftrue, iffalse)
+    @property
+    def capacity(self):
+        return len(self.__keys)
+
+    def __len__(self):
+        return self.__size
+
+    def __getitem__(self, key):
+        slot = hash(key) & self.__mask
+        existing = self.__keys[slot]
+        if existing is not None and existing == key:
+            self.hits += 1
+            return self.__values[slot]
+        self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = hash(key) & self.__mask
+        existing = self.__keys[slot]
+        if existing is None:
+            self.__size += 1
+        elif existing != key:
+            self.evictions += 1
+        self.__keys[slot] = key
+        self.__values[slot] = value
+        if (
+            4 * self.__size > 3 * len(self.__keys) and
+            len(self.__keys) < self.max_capacity
+        ):
+            self.__grow()
+
+    def __grow(self):
+        keys = self.__keys
+        values = self.__values
+        capacity = 2 * len(keys)
+        self.__keys = [None] * capacity
+        self.__values = [None] * capacity
+        self.__mask = capacity - 1
+        self.__size = 0
+        for key, value in zip(keys, values):
+            if key is not None:
+                slot = hash(key) & self.__mask
+                if self.__keys[slot] is None:
+                    self.__size += 1
+                self.__keys[slot] = key
+                self.__values[slot] = value
+
+    def purge(self, stale):
+        """Removes every entry for which stale returns True for its key or
+        its value."""
+        keys = self.__keys
+        values = self.__values
+        for slot, key in enumerate(keys):
+            if key is not None and (stale(key) or stale(values[slot])):
+                keys[slot] = None
+                values[slot] = None
+                self.__size -= 1
+
+    def clear(self):
+        capacity = len(self.__keys)
+        self.__keys = [None] * capacity
+        self.__values = [None] * capacity
+        self.__size = 0
+
+
+class LRUCache(object):
+    """A cache that charges each entry a cost and, once the total cost goes
+    over budget, evicts the least recently used entries until it fits."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __getitem__(self, key):
         try:
-            return self.__cache[key]
+            value, _ = self.__entries[key]
         except KeyError:
-            pass
-        reducediftrue = self.reduce(iftrue, choice, True)
-        reducediffalse = self.reduce(iffalse, choice, False)
-        otherkey = ("bdd", choice, reducediftrue, reducediffalse)
-        result = None
+            self.misses += 1
+            raise
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def store(self, key, value, cost):
+        entries = self.__entries
         try:
-            result = self.__cache[otherkey]
+            _, old_cost = entries.pop(key)
+            self.cost -= old_cost
         except KeyError:
             pass
+        entries[key] = (value, cost)
+        self.cost += cost
+        while self.cost > self.budget and entries:
+            _, (_, evicted_cost) = entries.popitem(last=False)
+            self.cost -= evicted_cost
+            self.evictions += 1
+
+    def purge(self, stale):
+        """Removes every entry for which stale returns True for its key or
+        its value."""
+        entries = self.__entries
+        for key in [
+            key for key, (value, _) in entries.items()
+            if stale(key) or stale(value)
+        ]:
+            _, cost = entries.pop(key)
+            self.cost -= cost
+
+    def clear(self):
+        self.__entries.clear()
+        self.cost = 0
+
+
+class DiagramBuilder(object):
+    def __init__(
+        self, capacity=1024, cache_budget=64 * 2 ** 20,
+        reorder_threshold=None,
+    ):
+        """capacity is the initial size of the unique table. cache_budget is
+        the approximate number of bytes that results kept between calls may
+        use: three quarters go to the computed cache of ite and reduce, and
+        the rest to finished pseudo-boolean constraints. Results beyond it
+        are evicted and recomputed when next needed.
+
+        If reorder_threshold is set, the builder sifts its variable order
+        whenever a top-level operation starts with more nodes than that, and
+        then at least doubles the threshold. Only handles registered with
+        ref(), and the operands of the operation, survive reordering, so
+        callers that turn it on must ref() everything they keep between
+        calls."""
+        assert capacity > 0 and capacity & (capacity - 1) == 0
+        self.computed_cache = ComputedCache.for_budget(cache_budget * 3 // 4)
+        self.pbc_cache = LRUCache(cache_budget // 4)
+        # Memo only present while a top-level ite or
+        # pseudo_boolean_constraint call is running, shared by everything
+        # that call does. Nothing is evicted from it, so a single build costs
+        # the same whatever the budget, and it is dropped as soon as the call
+        # returns: a small budget only loses reuse between calls.
+        self.__memo = None
+        self.__var = array('l', [TERMINAL_VARIABLE])
+        self.__high = array('l', [0])
+        self.__low = array('l', [0])
+        # Number of references to each node, from its parents plus any
+        # external ones registered with ref().
+        self.__refs = array('l', [1])
+        self.__free = []
+        self.__table = array('l', [EMPTY]) * capacity
+        self.__mask = capacity - 1
+        # Number of slots of the table that are not EMPTY.
+        self.__used = 0
+        # The variable order: the level of each variable, and the variable at
+        # each level. Variables are added below all existing ones when first
+        # used, and the terminal sits below everything.
+        self.__levels = {TERMINAL_VARIABLE: TERMINAL_VARIABLE}
+        self.__order = []
+        self.reorder_threshold = reorder_threshold
+
+    @property
+    def order(self):
+        """The variables from the top of the diagrams to the bottom."""
+        return list(self.__order)
+
+    def level(self, variable):
+        return self.__levels[variable]
+
+    @property
+    def node_count(self):
+        return len(self.__var) - 1 - len(self.__free)
+
+    def choice(self, node):
+        return self.__var[node >> 1]
+
+    def branches(self, node):
+        """Returns (choice, iftrue, iffalse) for a non-terminal handle, with
+        the complement bit of node pushed down onto both branches."""
+        assert not isinstance(node, bool)
+        index = node >> 1
+        complement = node & 1
+        iftrue = self.__high[index] ^ complement
+        iffalse = self.__low[index] ^ complement
+        if iftrue < 2:
+            iftrue = TERMINALS[iftrue]
+        if iffalse < 2:
+            iffalse = TERMINALS[iffalse]
+        return self.__var[index], iftrue, iffalse
+
+    def node(self, handle):
+        """Returns an IfThenElse view of handle, or handle itself if it is a
+        terminal."""
+        if isinstance(handle, bool):
+            return handle
+        return IfThenElse(self, handle)
+
+    def __node(self, choice, iftrue, iffalse):
+        # Looks up or creates the node for choice with already reduced
+        # children, through the open-addressing unique table. The then-branch
+        # of a stored node is never complemented: if it would be, we store the
+        # negation instead and return a complemented edge to it.
+        if iftrue == iffalse:
+            return iftrue
+        complement = iftrue & 1
+        if complement:
+            iftrue ^= 1
+            iffalse ^= 1
+        variables = self.__var
+        highs = self.__high
+        lows = self.__low
+        table = self.__table
+        mask = self.__mask
+        slot = node_hash(choice, iftrue, iffalse) & mask
+        while True:
+            existing = table[slot]
+            if existing == EMPTY:
+                break
+            if (
+                existing != DELETED and
+                variables[existing] == choice and
+                highs[existing] == iftrue and
+                lows[existing] == iffalse
+            ):
+                return (existing << 1) | complement
+            slot = (slot + 1) & mask
+        refs = self.__refs
+        refs[iftrue >> 1] += 1
+        refs[iffalse >> 1] += 1
+        if self.__free:
+            result = self.__free.pop()
+            variables[result] = choice
+            highs[result] = iftrue
+            lows[result] = iffalse
+            refs[result] = 0
+        else:
+            result = len(variables)
+            variables.append(choice)
+            highs.append(iftrue)
+            lows.append(iffalse)
+            refs.append(0)
+        table[slot] = result
+        self.__used += 1
+        if 2 * self.__used > len(table):
+            self.__grow()
+        return (result << 1) | complement
+
+    def __grow(self):
+        # Called once the table is half full. Tombstones left by reordering
+        # count towards that, so only double if live nodes alone fill a
+        # quarter of it.
+        capacity = len(self.__table)
+        if 4 * self.node_count > capacity:
+            capacity *= 2
+        self.__rehash(capacity)
+
+    def __rehash(self, capacity):
+        table = array('l', [EMPTY]) * capacity
+        mask = capacity - 1
+        variables = self.__var
+        highs = self.__high
+        lows = self.__low
+        used = 0
+        for node in range(1, len(variables)):
+            if variables[node] == FREE_VARIABLE:
+                continue
+            slot = node_hash(variables[node], highs[node], lows[node]) & mask
+            while table[slot] != EMPTY:
+                slot = (slot + 1) & mask
+            table[slot] = node
+            used += 1
+        self.__table = table
+        self.__mask = mask
+        self.__used = used
+
+    def __link(self, node):
+        # Inserts node, which must not already be present, into the unique
+        # table.
+        table = self.__table
+        mask = self.__mask
+        slot = node_hash(
+            self.__var[node], self.__high[node], self.__low[node]) & mask
+        while table[slot] != EMPTY:
+            slot = (slot + 1) & mask
+        table[slot] = node
+        self.__used += 1
+        if 2 * self.__used > len(table):
+            self.__grow()
+
+    def __unlink(self, node):
+        # Removes node from the unique table, leaving a tombstone in its slot.
+        table = self.__table
+        mask = self.__mask
+        slot = node_hash(
+            self.__var[node], self.__high[node], self.__low[node]) & mask
+        while table[slot] != node:
+            assert table[slot] != EMPTY
+            slot = (slot + 1) & mask
+        table[slot] = DELETED
+
+    def ref(self, node):
+        """Registers an external reference to node, keeping it and
+        everything below it alive across calls to collect(). Returns node."""
+        if not isinstance(node, bool):
+            assert self.__var[node >> 1] != FREE_VARIABLE, node
+            self.__refs[node >> 1] += 1
+        return node
+
+    def deref(self, node):
+        """Drops a reference previously registered with ref()."""
+        if not isinstance(node, bool):
+            assert self.__var[node >> 1] != FREE_VARIABLE, node
+            assert self.__refs[node >> 1] > 0
+            self.__refs[node >> 1] -= 1
+
+    def collect(self):
+        """Frees every node that cannot be reached from a handle registered
+        with ref(), and purges computed cache entries that mention them.
+        Unreferenced handles must not be used after this. Returns the number
+        of nodes freed."""
+        variables = self.__var
+        highs = self.__high
+        lows = self.__low
+        refs = self.__refs
+        dead = bytearray(len(variables))
+        stack = [
+            i for i in range(1, len(variables))
+            if refs[i] == 0 and variables[i] != FREE_VARIABLE
+        ]
+        freed = 0
+        while stack:
+            node = stack.pop()
+            dead[node] = 1
+            freed += 1
+            variables[node] = FREE_VARIABLE
+            self.__free.append(node)
+            for child in (highs[node] >> 1, lows[node] >> 1):
+                refs[child] -= 1
+                if refs[child] == 0:
+                    stack.append(child)
+        if freed:
+            self.__rehash(len(self.__table))
+            dead = {i for i, d in enumerate(dead) if d}
+
+            def stale(value):
+                return _mentions(value, dead)
+            self.computed_cache.purge(stale)
+            self.pbc_cache.purge(stale)
+        return freed
+
+    def __check_reorder(self, operands):
+        threshold = self.reorder_threshold
+        if threshold is None or self.node_count <= threshold:
+            return
+        for node in operands:
+            self.ref(node)
+        try:
+            self.reorder()
+        finally:
+            for node in operands:
+                self.deref(node)
+        self.reorder_threshold = 2 * max(threshold, self.node_count)
+
+    def reorder(self, max_growth=1.2):
+        """Improves the variable order by Rudell's sifting: each variable in
+        turn, largest first, is moved through every level by swapping
+        adjacent levels in place, and left where the diagrams were smallest.
+        A variable stops moving in one direction once the size passes
+        max_growth times the best seen so far.
+
+        Every referenced handle keeps denoting the same function. This runs
+        collect() first, so unreferenced handles become invalid. Returns the
+        number of nodes left."""
+        self.collect()
+        variables = self.__var
+        by_var = {v: [] for v in self.__order}
+        for node in range(1, len(variables)):
+            if variables[node] != FREE_VARIABLE:
+                by_var[variables[node]].append(node)
+        # Nodes freed while sifting are only handed back at the end, so no
+        # slot is reused while the caches may still mention it.
+        freed = []
+        for v in sorted(by_var, key=lambda v: -len(by_var[v])):
+            self.__sift(v, by_var, freed, max_growth)
+        if freed:
+            dead = set(freed)
+            self.__free.extend(freed)
+            self.pbc_cache.purge(
+                lambda value: _mentions(value, dead))
+        # Cached ite results are still correct, but their keys were
+        # normalised for the old order and would rarely be hit again.
+        self.computed_cache.clear()
+        return self.node_count
+
+    def __sift(self, v, by_var, freed, max_growth):
+        bottom = len(self.__order) - 1
+        best_size = self.node_count - len(freed)
+        best_level = self.__levels[v]
+        for direction, limit in ((1, bottom), (-1, 0)):
+            while self.__levels[v] != limit:
+                level = self.__levels[v]
+                self.__swap(min(level, level + direction), by_var, freed)
+                size = self.node_count - len(freed)
+                if size < best_size:
+                    best_size = size
+                    best_level = self.__levels[v]
+                elif size > max_growth * best_size:
+                    break
+        while self.__levels[v] < best_level:
+            self.__swap(self.__levels[v], by_var, freed)
+        while self.__levels[v] > best_level:
+            self.__swap(self.__levels[v] - 1, by_var, freed)
+
+    def swap(self, level):
+        """Swaps the variables at level and level + 1 in place. Like
+        reorder(), this runs collect() first."""
+        self.collect()
+        variables = self.__var
+        by_var = {v: [] for v in self.__order[level:level + 2]}
+        for node in range(1, len(variables)):
+            if variables[node] in by_var:
+                by_var[variables[node]].append(node)
+        freed = []
+        self.__swap(level, by_var, freed)
+        self.__free.extend(freed)
+        self.computed_cache.clear()
+        self.pbc_cache.clear()
+
+    def __swap(self, level, by_var, freed):
+        order = self.__order
+        x = order[level]
+        y = order[level + 1]
+        variables = self.__var
+        highs = self.__high
+        lows = self.__low
+        refs = self.__refs
+        staying = []
+        for node in by_var[x]:
+            if variables[node] != x:
+                continue
+            high = highs[node]
+            low = lows[node]
+            if variables[high >> 1] != y and variables[low >> 1] != y:
+                # Does not depend on y, so simply ends up one level lower.
+                staying.append(node)
+                continue
+            high1, high0 = self.__raw_cofactors(high, y)
+            low1, low0 = self.__raw_cofactors(low, y)
+            # Neither of these can be node itself, as they do not depend on
+            # y. They are made before node leaves the unique table, since
+            # making them may rehash it.
+            newhigh = self.__node(x, high1, low1)
+            newlow = self.__node(x, high0, low0)
+            self.__unlink(node)
+            for child in (newhigh >> 1, newlow >> 1):
+                if variables[child] == x and refs[child] == 0:
+                    staying.append(child)
+                refs[child] += 1
+            variables[node] = y
+            highs[node] = newhigh
+            lows[node] = newlow
+            self.__link(node)
+            by_var[y].append(node)
+            self.__release(high >> 1, freed)
+            self.__release(low >> 1, freed)
+        by_var[x] = staying
+        order[level] = y
+        order[level + 1] = x
+        self.__levels[y] = level
+        self.__levels[x] = level + 1
+
+    def __raw_cofactors(self, edge, choice):
+        index = edge >> 1
+        if self.__var[index] != choice:
+            return edge, edge
+        complement = edge & 1
+        return self.__high[index] ^ complement, self.__low[index] ^ complement
+
+    def __release(self, node, freed):
+        # Drops one reference to node, freeing it and anything that only it
+        # kept alive.
+        variables = self.__var
+        refs = self.__refs
+        refs[node] -= 1
+        stack = [node] if refs[node] == 0 else []
+        while stack:
+            node = stack.pop()
+            self.__unlink(node)
+            variables[node] = FREE_VARIABLE
+            freed.append(node)
+            for child in (self.__high[node] >> 1, self.__low[node] >> 1):
+                refs[child] -= 1
+                if refs[child] == 0:
+                    stack.append(child)
+
+    def variable(self, i):
+        if i not in self.__levels:
+            self.__levels[i] = len(self.__order)
+            self.__order.append(i)
+        return self.__node(i, True, False)
+
+    def bdd(self, choice, iftrue, iffalse):
+        return self.ite(self.variable(choice), iftrue, iffalse)
+
+    def ite(self, f, g, h):
+        """Returns the diagram for "if f then g else h". Every other binary
+        operation is expressed through this one, so they all share a single
+        computed table."""
+        if self.__memo is not None:
+            return self.__ite(f, g, h)
+        self.__check_reorder((f, g, h))
+        self.__memo = {}
+        try:
+            return self.__ite(f, g, h)
+        finally:
+            self.__memo = None
+
+    def __ite(self, f, g, h):
+        # Terminal cases.
+        if f is True:
+            return g
+        if f is False:
+            return h
+        if g == h:
+            return g
+        # Replace arguments that coincide with f (or its negation) by
+        # constants, which lets more calls hit the cases below.
+        if g == f:
+            g = True
+        elif g == f ^ 1:
+            g = False
+        if h == f:
+            h = False
+        elif h == f ^ 1:
+            h = True
+        if g is True and h is False:
+            return f
+        if g is False and h is True:
+            return f ^ 1
+
+        # Standard triples: of the equivalent ways to write the same call,
+        # pick the one whose first argument comes first.
+        if g is True:
+            # ite(f, 1, h) == ite(h, 1, f)
+            if not isinstance(h, bool) and self.__precedes(h, f):
+                f, h = h, f
+        elif g is False:
+            # ite(f, 0, h) == ite(~h, 0, ~f)
+            if not isinstance(h, bool) and self.__precedes(h, f):
+                f, h = h ^ 1, f ^ 1
+        elif h is False:
+            # ite(f, g, 0) == ite(g, f, 0)
+            if self.__precedes(g, f):
+                f, g = g, f
+        elif h is True:
+            # ite(f, g, 1) == ite(~g, ~f, 1)
+            if self.__precedes(g, f):
+                f, g = g ^ 1, f ^ 1
+        elif g == h ^ 1:
+            # ite(f, g, ~g) == ite(g, f, ~f)
+            if self.__precedes(g, f):
+                f, g, h = g, f, f ^ 1
+
+        # Complement normalisation: f and g are always regular in the
+        # computed table.
+        if f & 1:
+            f ^= 1
+            g, h = h, g
+        complement = False
+        if g & 1:
+            complement = True
+            g = self._not(g)
+            h = self._not(h)
+
+        key = (f, g, h)
+        memo = self.__memo
+        result = memo.get(key)
         if result is None:
-            if reducediftrue == reducediffalse:
-                result = reducediftrue
-            else:
-                result = IfThenElse(
-                    self.__id_counter,
-                    choice, reducediftrue, reducediffalse)
-        for k in (key, otherkey):
-            self.__cache[k] = result
+            try:
+                result = self.computed_cache[key]
+            except KeyError:
+                pass
+        if result is None:
+            variables = self.__var
+            levels = self.__levels
+            top = self.__order[min(
+                levels[variables[f >> 1]],
+                levels[variables[g >> 1]],
+                levels[variables[h >> 1]],
+            )]
+            f1, f0 = self.__cofactors(f, top)
+            g1, g0 = self.__cofactors(g, top)
+            h1, h0 = self.__cofactors(h, top)
+            result = self.__node(
+                top, self.__ite(f1, g1, h1), self.__ite(f0, g0, h0))
+            self.computed_cache[key] = result
+        memo[key] = result
+        if complement:
+            return self._not(result)
         return result
 
+    def __precedes(self, x, y):
+        variables = self.__var
+        levels = self.__levels
+        xlevel = levels[variables[x >> 1]]
+        ylevel = levels[variables[y >> 1]]
+        return xlevel < ylevel or (xlevel == ylevel and x < y)
+
+    def __cofactors(self, f, choice):
+        if isinstance(f, bool) or self.__var[f >> 1] != choice:
+            return f, f
+        _, iftrue, iffalse = self.branches(f)
+        return iftrue, iffalse
+
     def _and(self, *terms):
+        if False in terms:
+            return False
+        terms = [t for t in terms if t is not True]
         if not terms:
             return True
         if len(terms) == 1:
             return terms[0]
-        if len(terms) == 2:
-            return self.__binand(*terms)
-
-        if False in terms:
-            return False
-
-        terms = [t for t in terms if t is not True]
-        terms.sort(key=NodeKey)
-        key = ('_and', tuple(terms))
-        try:
-            return self.__cache[key]
-        except KeyError:
-            pass
+        # Conjoin from the deepest term upwards, so that each step puts the
+        # new term on top of what has been built instead of threading it
+        # underneath the whole accumulated diagram.
+        if self.__memo is None:
+            # Reordering between the steps below would collect the terms
+            # not yet conjoined, so the whole fold is one top-level call.
+            self.__check_reorder(terms)
+            self.__memo = {}
+            try:
+                return self._and(*terms)
+            finally:
+                self.__memo = None
+        terms.sort(key=lambda t: NodeKey(self, t), reverse=True)
         result = True
         for t in terms:
-            result = self.__binand(result, t)
+            result = self.__ite(t, result, False)
             if result is False:
                 break
-        self.__cache[key] = result
         return result
 
-    def __binand(self, x, y):
-        key = ("_binand", x, y)
-        keys = [key]
+    def pseudo_boolean_constraint(self, formula, lower_bound, upper_bound):
+        formula = canonicalize(formula)
+        key = (formula, lower_bound, upper_bound)
+        memo = self.__memo
+        if memo is not None:
+            try:
+                return memo[key]
+            except KeyError:
+                pass
+            result = self.__pseudo_boolean_constraint(
+                formula, lower_bound, upper_bound)
+            memo[key] = result
+            return result
+
         try:
-            return self.__cache[key]
+            return self.pbc_cache[key]
         except KeyError:
             pass
-        if x is False:
-            result = False
-        elif y is False:
-            result = False
-        elif x is True:
-            result = y
-        elif y is True:
-            result = x
-        else:
-            assert isinstance(x, GraphNode)
-            assert isinstance(y, GraphNode)
-            if x is y:
-                result = x
-            else:
-                keys.append(("_binand", y, x))
-                if y.number < x.number:
-                    x, y = y, x
-                if x.choice == y.choice:
-                    result = self.bdd(
-                        x.choice,
-                        self._and(x.iftrue, y.iftrue),
-                        self._and(x.iffalse, y.iffalse),
-                    )
-                else:
-                    if y.choice < x.choice:
-                        x, y = y, x
-                    result = self.bdd(
-                        x.choice,
-                        self.__binand(x.iftrue, y),
-                        self.__binand(x.iffalse, y),
-                    )
-        for k in keys:
-            self.__cache[k] = result
+        self.__check_reorder([t for _, t in formula])
+        self.__memo = {}
+        try:
+            result = self.__pseudo_boolean_constraint(
+                formula, lower_bound, upper_bound)
+        finally:
+            self.__memo = None
+        self.pbc_cache.store(
+            key, result,
+            CACHE_ENTRY_BYTES + FORMULA_TERM_BYTES * len(formula))
         return result
 
-    @cached
-    def pseudo_boolean_constraint(self, formula, lower_bound, upper_bound):
-        formula = list(map(tuple, formula))
+    def __pseudo_boolean_constraint(self, formula, lower_bound, upper_bound):
+        formula = list(formula)
         if not formula:
             return lower_bound <= 0 <= upper_bound
 
@@ -144,13 +792,11 @@ class DiagramBuilder(object):
         ]
 
         formula.sort(
-            key=lambda ct: (-abs(ct[0]), NodeKey(ct[1]))
+            key=lambda ct: (-abs(ct[0]), NodeKey(self, ct[1]))
         )
 
-        normalized = []
-        forced = True
-        for i in range(len(formula)):
-            coefficient, term = formula[i]
+        positive = []
+        for coefficient, term in formula:
             if coefficient == 0:
                 continue
             if isinstance(term, bool):
@@ -163,6 +809,13 @@ class DiagramBuilder(object):
                 term = self._not(term)
                 lower_bound += coefficient
                 upper_bound += coefficient
+            positive.append((coefficient, term))
+
+        # Only once every negative coefficient has shifted the bounds can we
+        # tell which terms are too heavy to ever be true.
+        normalized = []
+        forced = True
+        for coefficient, term in positive:
             if coefficient > upper_bound:
                 forced = self._and(forced, self._not(term))
                 if forced is False:
@@ -180,11 +833,11 @@ class DiagramBuilder(object):
             return False
         if total <= upper_bound and lower_bound <= 0:
             return forced
-        if isinstance(forced, GraphNode):
+        if not isinstance(forced, bool):
             normalized = []
             for coefficient, term in formula:
                 restricted = self._and(term, forced)
-                if comparenodes(restricted, term) < 0:
+                if self.compare(restricted, term) < 0:
                     if isinstance(restricted, bool):
                         if restricted:
                             lower_bound -= coefficient
@@ -212,7 +865,7 @@ class DiagramBuilder(object):
             upper_bound //= divide_by
             formula = [(c // divide_by, t) for c, t in formula]
         formula.sort(
-            key=lambda ct: (-abs(ct[0]), NodeKey(ct[1]))
+            key=lambda ct: (-abs(ct[0]), NodeKey(self, ct[1]))
         )
         return self._and(
             forced,
@@ -221,190 +874,167 @@ class DiagramBuilder(object):
             )
         )
 
-    @cached
     def __pbc_normalized_already(self, formula, lower_bound, upper_bound):
+        formula = tuple(formula)
+        key = ("normalized", formula, lower_bound, upper_bound)
+        memo = self.__memo
+        try:
+            return memo[key]
+        except KeyError:
+            pass
         coefficient, term = formula[0]
         rest = formula[1:]
-        return self.if_then_else(
+        result = self.if_then_else(
             term,
             self.pseudo_boolean_constraint(
                 rest, lower_bound - coefficient, upper_bound - coefficient),
             self.pseudo_boolean_constraint(
                 rest, lower_bound, upper_bound)
         )
+        memo[key] = result
+        return result
 
     def if_then_else(self, x, y, z):
-        return self._or(
-            self._and(x, y),
-            self._and(self._not(x), z),
-        )
+        return self.ite(x, y, z)
 
     def _or(self, *terms):
-        key = ("_or", tuple(terms))
-        try:
-            return self.__cache[key]
-        except KeyError:
-            pass
-        result = self._not(self._and(*(map(self._not, terms))))
-        self.__cache[key] = result
-        return result
+        return self._not(self._and(*map(self._not, terms)))
 
     def _not(self, x):
         if isinstance(x, bool):
             return not x
+        return x ^ 1
 
-        key = ('_not', x)
-        try:
-            return self.__cache[key]
-        except KeyError:
-            pass
-        result = self.bdd(x.choice, self._not(x.iftrue), self._not(x.iffalse))
-        self.__cache[key] = result
-        self.__cache[('_not', result)] = x
-        return result
-
-    @cached
     def _xor(self, x, y):
-        return self._or(
-            self._and(self._not(x), y),
-            self._and(x, self._not(y)),
-        )
+        return self.ite(x, self._not(y), y)
 
     def reduce(self, bdd, variable, value):
+        level = self.__levels.get(variable)
+        if level is None or level < self.__levels[self.__var[bdd >> 1]]:
+            return bdd
+        # Restriction commutes with negation, so we only ever compute it for
+        # the regular edge.
+        complement = bdd & 1
+        if complement:
+            return self._not(self.reduce(bdd ^ 1, variable, value))
         key = ("reduce", bdd, variable, value)
         try:
-            return self.__cache[key]
+            return self.computed_cache[key]
         except KeyError:
             pass
-        if isinstance(bdd, bool):
-            result = bdd
-        elif variable < bdd.minvar:
-            result = bdd
-        elif variable == bdd.choice:
+        choice, iftrue, iffalse = self.branches(bdd)
+        if variable == choice:
             if value:
-                result = bdd.iftrue
+                result = iftrue
             else:
-                result = bdd.iffalse
+                result = iffalse
         else:
-            result = self.bdd(
-                bdd.choice,
-                self.reduce(bdd.iftrue, variable, value),
-                self.reduce(bdd.iffalse, variable, value),
+            result = self.__node(
+                choice,
+                self.reduce(iftrue, variable, value),
+                self.reduce(iffalse, variable, value),
             )
-        self.__cache[key] = result
+        self.computed_cache[key] = result
         return result
 
-
-class GraphNode(object):
-    # Required properties: root, minvar, canonical
-
-    def variables(self):
+    def variables(self, bdd):
         result = set()
-        table = set()
-        self.add_variables_to_set(result, table)
+        if isinstance(bdd, bool):
+            return result
+        variables = self.__var
+        highs = self.__high
+        lows = self.__low
+        seen = {bdd >> 1}
+        stack = [bdd >> 1]
+        while stack:
+            index = stack.pop()
+            result.add(variables[index])
+            for child in (highs[index] >> 1, lows[index] >> 1):
+                if child != 0 and child not in seen:
+                    seen.add(child)
+                    stack.append(child)
         return result
 
-    def add_variables_to_set(self, result, table):
-        if self in table:
-            return
-        result.add(self.minvar)
-        for c in self.children():
-            c.add_variables_to_set(result, table)
-
-    def best_version(self):
-        seen = []
-        root = self
-        while isinstance(root, GraphNode) and root.root is not None:
-            seen.append(root)
-            root = root.root
-        for s in seen:
-            s.root = root
-        return root
-
-    def merge(self, other):
-        selfroot = self.best_version()
-        otherroot = other.best_version()
-        if selfroot != otherroot:
-            if comparenodes(selfroot, otherroot) < 0:
-                otherroot.root = selfroot
+    def evaluate(self, bdd, assignment):
+        while not isinstance(bdd, bool):
+            choice, iftrue, iffalse = self.branches(bdd)
+            bdd = iftrue if assignment[choice] else iffalse
+        return bdd
+
+    def compare(self, left, right):
+        if isinstance(left, bool):
+            if isinstance(right, bool):
+                return right - left
             else:
-                selfroot.root = otherroot
+                return -1
+        if isinstance(right, bool):
+            return 1
+        if left == right:
+            return 0
+        leftchoice, lefttrue, leftfalse = self.branches(left)
+        rightchoice, righttrue, rightfalse = self.branches(right)
+        leftlevel = self.__levels[leftchoice]
+        rightlevel = self.__levels[rightchoice]
+        if leftlevel < rightlevel:
+            return -1
+        if rightlevel < leftlevel:
+            return 1
+        c = self.compare(lefttrue, righttrue)
+        if c != 0:
+            return c
+        return self.compare(leftfalse, rightfalse)
 
-    def evaluate(self, assignment, table=None):
-        if table is None:
-            table = {}
-        try:
-            return table[self]
-        except KeyError:
-            pass
-        self = self.best_version()
-        result = self._evaluate(assignment, table)
-        table[self] = result
-        return result
 
+class IfThenElse(object):
+    """A read-only view of the node with the given handle in builder.
+
+    Views are only created on demand by DiagramBuilder.node(); the builder
+    itself works on the integer handles. Two views are equal when they view
+    the same handle of the same builder."""
 
-class IfThenElse(GraphNode):
-    def __init__(self, number, choice, iftrue, iffalse):
-        self.number = number
-        self.choice = choice
-        self.iftrue = iftrue
-        self.iffalse = iffalse
-        self.canonical = True
-        self.root = None
-        if isinstance(iftrue, GraphNode):
-            assert choice < iftrue.choice
-            self.canonical = self.canonical and iftrue.canonical
-        if isinstance(iffalse, GraphNode):
-            assert choice < iffalse.choice
-            self.canonical = self.canonical and iffalse.canonical
+    def __init__(self, builder, handle):
+        self.builder = builder
+        self.handle = handle
 
     @property
-    def minvar(self):
-        return self.choice
+    def choice(self):
+        return self.builder.choice(self.handle)
 
-    def children(self):
-        for v in (self.iftrue, self.iffalse):
-            if isinstance(v, GraphNode):
-                yield v
+    @property
+    def iftrue(self):
+        return self.builder.node(self.builder.branches(self.handle)[1])
 
-    def __repr__(self):
-        return "IfThenElse(%r, %r, %r)" % (
-            self.choice, self.iftrue, self.iffalse)
+    @property
+    def iffalse(self):
+        return self.builder.node(self.builder.branches(self.handle)[2])
 
-    def _evaluate(self, assignment, table):
-        child = self.iftrue if assignment[self.choice] else self.iffalse
-        if isinstance(child, bool):
-            return child
-        return child.evaluate(assignment, table)
+    def variables(self):
+        return self.builder.variables(self.handle)
 
+    def evaluate(self, assignment):
+        return self.builder.evaluate(self.handle, assignment)
 
-def comparenodes(left, right):
-    if isinstance(left, bool):
-        if isinstance(right, bool):
-            return right - left
-        else:
-            return -1
-    if isinstance(right, bool):
-        return 1
-    if left.canonical > right.canonical:
-        return -1
-    if right.canonical > left.canonical:
-        return 1
-    assert isinstance(left, IfThenElse)
-    assert isinstance(right, IfThenElse)
-    if left.minvar < right.minvar:
-        return -1
-    if right.minvar < left.minvar:
-        return 1
-    assert left.minvar == right.minvar
-    c = comparenodes(left.iftrue, right.iftrue)
-    if c != 0:
-        return c
-    return comparenodes(left.iffalse, right.iffalse)
+    def __eq__(self, other):
+        return (
+            isinstance(other, IfThenElse) and
+            self.builder is other.builder and
+            self.handle == other.handle
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.handle)
+
+    def __repr__(self):
+        return "IfThenElse(%r, %r, %r)" % (
+            self.choice, self.iftrue, self.iffalse)
 
 
 class NodeKey(object):
-    def __init__(self, node):
+    def __init__(self, builder, node):
+        self.builder = builder
         self.node = node
 
     def __cmp__(self, other):
@@ -412,7 +1042,7 @@ class NodeKey(object):
             raise TypeError("Cannot compare NodeKey to %r of type %s" % (
                 other, type(other).__name__
             ))
-        return comparenodes(self.node, other.node)
+        return self.builder.compare(self.node, other.node)
 
     def __le__(self, other):
         return self.__cmp__(other) <= 0
@@ -445,7 +1075,8 @@ def gcd(a, *bs):
 
 
 class CNFMapper(object):
-    def __init__(self):
+    def __init__(self, builder):
+        self.builder = builder
         self.last_variable = 0
         self.cnf = []
         self.variables = set()
@@ -479,15 +1110,19 @@ class CNFMapper(object):
             return self.true_var()
         if term is False:
             return self.false_var()
-        choice_var = self.remapped_variable(term.choice)
-        if term.iftrue is True and term.iffalse is False:
+        if term & 1:
+            # A complemented edge shares its node's variable.
+            return -self.variable_for_term(term ^ 1)
+        choice, iftrue, iffalse = self.builder.branches(term)
+        choice_var = self.remapped_variable(choice)
+        if iftrue is True and iffalse is False:
             return choice_var
-        if term.iftrue is False and term.iffalse is True:
+        if iftrue is False and iffalse is True:
             return -choice_var
 
         termvar = self.next_variable()
-        truetermvar = self.variable_for_term(term.iftrue)
-        falsetermvar = self.variable_for_term(term.iffalse)
+        truetermvar = self.variable_for_term(iftrue)
+        falsetermvar = self.variable_for_term(iffalse)
 
         # Now we add cnf terms so that termvar = ite(choice_var, truetermvar,
         # falsetermvar).
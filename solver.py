@@ -4,9 +4,11 @@ from expression import variable, Binary, is_arithmetic, Unary, Expression
 
 
 class Solver(object):
-    def __init__(self, backend=minisat):
+    def __init__(self, backend=minisat, reorder_threshold=2 ** 16):
         self.backend = backend
-        self.builder = DiagramBuilder()
+        # Everything the solver keeps is referenced through compile_cache, so
+        # the builder is free to reorder its variables between operations.
+        self.builder = DiagramBuilder(reorder_threshold=reorder_threshold)
         self.names_to_indices = {}
         self.indices_to_names = []
         self.compile_cache = {}
@@ -17,8 +19,8 @@ class Solver(object):
             return {}
         if bdd is False:
             raise Unsatisfiable()
-        mapper = CNFMapper()
-        for v in bdd.variables():
+        mapper = CNFMapper(self.builder)
+        for v in self.builder.variables(bdd):
             mapper.remapped_variable(v)
         termvar = mapper.variable_for_term(bdd)
         cnf = list(mapper.cnf)
@@ -27,7 +29,8 @@ class Solver(object):
         if solution is None:
             raise Unsatisfiable()
         relevant_variables = [
-            (i, self.indices_to_names[i]) for i in bdd.variables()]
+            (i, self.indices_to_names[i])
+            for i in self.builder.variables(bdd)]
         return {
             name: mapper.remapped_variable(index) in solution
             for index, name in relevant_variables
@@ -39,7 +42,7 @@ class Solver(object):
 
         key = id(expression)
         try:
-            return self.compile_cache[key]
+            return self.compile_cache[key][1]
         except KeyError:
             pass
 
@@ -47,7 +50,7 @@ class Solver(object):
 
         if isinstance(expression, variable):
             try:
-                i = self.names_to_indices[expression.name],
+                i = self.names_to_indices[expression.name]
             except KeyError:
                 i = len(self.names_to_indices)
                 self.names_to_indices[expression.name] = i
@@ -67,39 +70,7 @@ class Solver(object):
                 left = expression.left
                 right = expression.right
                 if op in ('==', '!=', '<=', '>=', '<', '>'):
-                    if op == '!=':
-                        result = bld._or(
-                            self.compile(left < right),
-                            self.compile(left > right),
-                        )
-                    else:
-                        if isinstance(right, Expression):
-                            left -= right
-                            right = 0
-                        flattened = self.__flatten_arithmetic(left)
-                        low = sum(
-                            min(0, c) for c, _ in flattened
-                        )
-                        high = sum(
-                            max(0, c) for c, _ in flattened
-                        )
-                        if op == '==':
-                            low = right
-                            high = right
-                        elif op == '<=':
-                            high = right
-                        elif op == '>=':
-                            low = right
-                        elif op == '<':
-                            high = right - 1
-                        elif op == '>':
-                            low = right + 1
-                        else:
-                            assert False
-                        result = bld.pseudo_boolean_constraint(
-                            [(c, self.compile(t)) for c, t in flattened],
-                            low, high
-                        )
+                    result = self.__compile_comparison(op, left, right)
                 else:
                     for v in (left, right):
                         if is_arithmetic(v):
@@ -118,10 +89,8 @@ class Solver(object):
                 elif op in ('^', '!='):
                     result = bld._xor(left, right)
                 elif op == '==':
-                    result = bld._or(
-                        bld._and(left, right),
-                        bld._and(left, right),
-                    )
+                    both = bld._and(left, right)
+                    result = bld._or(both, both)
                 elif op == '<=':
                     result = bld._or(bld._not(left), right)
                 elif op == '<':
@@ -135,9 +104,87 @@ class Solver(object):
                     raise ValueError(
                         "Cannot compile arithmetic expression %r" % (
                             expression))
-        self.compile_cache[key] = result
+        # Keep the expression alive alongside its result so that its id
+        # cannot be reused by a later, different expression.
+        self.compile_cache[key] = (expression, bld.ref(result))
         return result
 
+    def __compile_comparison(self, op, left, right):
+        bld = self.builder
+        if op == '!=':
+            # Compiled directly rather than via compile() so that no
+            # temporary expression ends up in the compile cache.
+            # The first half must stay referenced in case building the
+            # second one reorders the diagram.
+            below = bld.ref(self.__compile_comparison('<', left, right))
+            try:
+                return bld._or(
+                    below, self.__compile_comparison('>', left, right))
+            finally:
+                bld.deref(below)
+        if isinstance(right, Expression):
+            left -= right
+            right = 0
+        flattened = self.__flatten_arithmetic(left)
+        low = sum(
+            min(0, c) for c, _ in flattened
+        )
+        high = sum(
+            max(0, c) for c, _ in flattened
+        )
+        if op == '==':
+            low = right
+            high = right
+        elif op == '<=':
+            high = right
+        elif op == '>=':
+            low = right
+        elif op == '<':
+            high = right - 1
+        elif op == '>':
+            low = right + 1
+        else:
+            assert False
+        return bld.pseudo_boolean_constraint(
+            [(c, self.compile(t)) for c, t in flattened],
+            low, high
+        )
+
+    def release(self, expression):
+        """Forgets the compiled forms of expression and its subexpressions,
+        so that the next collect() can free the nodes only they were using.
+        Other compiled expressions are unaffected, although any that share
+        subexpressions with this one will compile those again if needed."""
+        seen = set()
+        stack = [expression]
+        while stack:
+            expression = stack.pop()
+            if not isinstance(expression, Expression):
+                continue
+            key = id(expression)
+            if key in seen:
+                continue
+            seen.add(key)
+            entry = self.compile_cache.get(key)
+            if entry is not None and entry[0] is expression:
+                del self.compile_cache[key]
+                self.builder.deref(entry[1])
+            if isinstance(expression, Binary):
+                stack.append(expression.left)
+                stack.append(expression.right)
+            elif isinstance(expression, Unary):
+                stack.append(expression.term)
+
+    def collect(self):
+        """Forgets every compiled expression and frees the diagram nodes
+        that only they were using, so that a long-lived Solver does not grow
+        without bound. Use release() to forget a single expression and
+        builder.collect() to sweep without forgetting anything else."""
+        for _, result in self.compile_cache.values():
+            self.builder.deref(result)
+        self.compile_cache.clear()
+        return self.builder.collect()
+
     def __flatten_arithmetic(self, value):
         if not is_arithmetic(value):
             return [(1, value)]
@@ -98,7 +98,7 @@ def test_solutions_to_linear_constraints_satisfy_them(ls, m, n):
         [(c, builder.variable(i)) for i, c in enumerate(ls)], m, n
     )
     assume(not isinstance(bdd, bool))
-    mapper = CNFMapper()
+    mapper = CNFMapper(builder)
     termvar = mapper.variable_for_term(bdd)
     cnf = list(mapper.cnf)
     cnf.append((termvar,))
@@ -106,11 +106,12 @@ def test_solutions_to_linear_constraints_satisfy_them(ls, m, n):
     assume(solution is not None)
     assignment = {
         v: mapper.remapped_variable(v) in solution
-        for v in bdd.variables()
+        for v in builder.variables(bdd)
     }
-    assert bdd.evaluate(assignment)
+    assert builder.evaluate(bdd, assignment)
     score = sum(
-        s for i, s in enumerate(ls) if i in bdd.variables() and assignment[i]
+        s for i, s in enumerate(ls)
+        if i in builder.variables(bdd) and assignment[i]
     )
     assert m <= score <= n
 
@@ -121,3 +122,163 @@ def test_strict_equality_ruling_out_one_variable():
     v1 = builder.variable(1)
     pbc = builder.pseudo_boolean_constraint([(2, v0), (1, v1)], 1, 1)
     assert pbc == builder._and(builder._not(v0), v1)
+
+
+def test_negation_shares_nodes():
+    builder = DiagramBuilder()
+    x = builder._and(*[builder.variable(i) for i in range(3)])
+    count = builder.node_count
+    notx = builder._not(x)
+    assert builder.node_count == count
+    assert notx != x
+    assert builder._not(notx) == x
+    assert builder._and(x, notx) is False
+    assert builder._or(x, notx) is True
+
+
+def test_negative_coefficients_shift_bounds_before_forcing():
+    builder = DiagramBuilder()
+    ts = [builder.variable(i) for i in range(4)]
+    pbc = builder.pseudo_boolean_constraint(
+        list(zip([-1, 3, -3, 2], ts)), -6, -2)
+    assert builder.evaluate(pbc, {0: True, 1: False, 2: True, 3: True})
+
+
+def test_ite_agrees_with_and_or():
+    builder = DiagramBuilder()
+    x, y, z = [builder.variable(i) for i in range(3)]
+    assert builder.ite(x, y, z) == builder._or(
+        builder._and(x, y), builder._and(builder._not(x), z))
+    assert builder.ite(y, x, False) == builder.ite(x, y, False)
+    assert builder.ite(x, True, y) == builder._or(y, x)
+    assert builder.ite(x, builder._not(y), y) == builder._xor(y, x)
+
+
+def test_small_cache_budget_evicts_but_stays_correct():
+    small = DiagramBuilder(cache_budget=1024)
+    large = DiagramBuilder()
+    results = []
+    for builder in (small, large):
+        ts = [builder.variable(i) for i in range(12)]
+        bdd = builder.pseudo_boolean_constraint(
+            [(i + 1, t) for i, t in enumerate(ts)], 20, 40)
+        results.append(sorted(
+            i for i in range(2 ** 12)
+            if builder.evaluate(bdd, {j: bool(i >> j & 1) for j in range(12)})
+        ))
+    assert results[0] == results[1]
+    cache = small.computed_cache
+    assert cache.capacity <= 1024 // 128
+    assert len(cache) <= cache.capacity
+    assert cache.evictions > 0
+    assert cache.misses > 0
+
+
+def test_collect_frees_unreferenced_nodes():
+    builder = DiagramBuilder()
+    ts = [builder.ref(builder.variable(i)) for i in range(8)]
+    kept = builder.ref(builder.pseudo_boolean_constraint(
+        [(1, t) for t in ts], 3, 5))
+    builder.collect()
+    live = builder.node_count
+    builder._xor(builder._and(*ts[:4]), builder._or(*ts[4:]))
+    assert builder.node_count > live
+    assert builder.collect() > 0
+    assert builder.node_count == live
+    assert builder.collect() == 0
+    assert kept == builder.pseudo_boolean_constraint(
+        [(1, t) for t in ts], 3, 5)
+    builder.deref(kept)
+    for t in ts:
+        builder.deref(t)
+    builder.collect()
+    assert builder.node_count == 0
+
+
+def test_deref_of_collected_handle_is_rejected():
+    builder = DiagramBuilder()
+    x = builder._and(builder.variable(0), builder.variable(1))
+    builder.collect()
+    with pytest.raises(AssertionError):
+        builder.deref(x)
+
+
+def test_small_cache_budget_does_not_blow_up_a_single_build():
+    misses = []
+    for budget in (64 * 2 ** 20, 16 * 1024):
+        builder = DiagramBuilder(cache_budget=budget)
+        ts = [builder.variable(i) for i in range(16)]
+        builder.pseudo_boolean_constraint(
+            [(3 * i % 17 + 1, t) for i, t in enumerate(ts)], 30, 60)
+        misses.append(builder.computed_cache.misses)
+    assert misses[1] <= 2 * misses[0]
+
+
+def test_pseudo_boolean_cache_charges_for_formula_width():
+    builder = DiagramBuilder(cache_budget=16 * 1024)
+    ts = [builder.variable(i) for i in range(30)]
+    for k in range(20):
+        builder.pseudo_boolean_constraint([(1, t) for t in ts], k, 30)
+    cache = builder.pbc_cache
+    assert 0 < cache.cost <= cache.budget
+    assert cache.evictions > 0
+
+
+def test_wide_conjunction_creates_linearly_many_nodes():
+    builder = DiagramBuilder()
+    ts = [builder.variable(i) for i in range(500)]
+    conjunction = builder._and(*ts)
+    assert builder.node_count < 2 * len(ts)
+    assert builder.evaluate(conjunction, {i: True for i in range(500)})
+
+
+def test_reorder_shrinks_interleavable_sum_of_products():
+    n = 8
+    builder = DiagramBuilder()
+    xs = [builder.variable(i) for i in range(n)]
+    ys = [builder.variable(n + i) for i in range(n)]
+    bdd = builder.ref(builder._or(*[
+        builder._and(x, y) for x, y in zip(xs, ys)]))
+    builder.collect()
+    assert builder.node_count > 2 ** n
+    assert builder.reorder() <= 2 * n
+    assert builder.level(n) == builder.level(0) + 1
+    assert bdd == builder._or(*[
+        builder._and(builder.variable(i), builder.variable(n + i))
+        for i in range(n)])
+
+
+@given(st.lists(st.integers(-3, 3), min_size=2, max_size=6), st.data())
+def test_swapping_levels_preserves_functions(coefficients, data):
+    n = len(coefficients)
+    builder = DiagramBuilder(capacity=2)
+    ts = [builder.ref(builder.variable(i)) for i in range(n)]
+    bdd = builder.ref(builder.pseudo_boolean_constraint(
+        list(zip(coefficients, ts)), -2, 2))
+    assignments = [
+        {j: bool(i >> j & 1) for j in range(n)} for i in range(2 ** n)]
+    expected = [builder.evaluate(bdd, a) for a in assignments]
+    for level in data.draw(st.lists(st.integers(0, n - 2), max_size=8)):
+        builder.swap(level)
+        assert [builder.evaluate(bdd, a) for a in assignments] == expected
+    assert bdd == builder.pseudo_boolean_constraint(
+        list(zip(coefficients, ts)), -2, 2)
+
+
+def test_reorder_threshold_triggers_and_keeps_referenced_handles():
+    n = 6
+    builder = DiagramBuilder(reorder_threshold=64)
+    for i in range(2 * n):
+        builder.variable(i)
+    pairs = [
+        builder._and(builder.variable(i), builder.variable(n + i))
+        for i in range(n)]
+    bdd = builder.ref(builder._or(*pairs))
+    assert builder.reorder_threshold == 64
+    builder._and(bdd, builder.variable(0))
+    assert builder.reorder_threshold > 64
+    assert builder.order != list(range(2 * n))
+    assignment = {i: i in (0, n) for i in range(2 * n)}
+    assert builder.evaluate(bdd, assignment)
+    assignment[n] = False
+    assert not builder.evaluate(bdd, assignment)
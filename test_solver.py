@@ -134,3 +134,48 @@ def test_solutions_to_one_way_linear_constraints_satisfy_them(ls, m, b):
         assignment.setdefault(i, b)
 
     assert m <= objective.evaluate(assignment)
+
+
+def test_collect_releases_compiled_expressions():
+    solver = Solver()
+    ts = [variable(i) for i in range(10)]
+    solver.compile(sum(ts) >= 5)
+    assert solver.builder.node_count > 0
+    solver.collect()
+    assert solver.builder.node_count == 0
+    assert solver.solve(ts[0] & ts[1]) == {0: True, 1: True}
+
+
+def test_release_only_forgets_one_expression():
+    solver = Solver()
+    ts = [variable(i) for i in range(10)]
+    first = sum(ts) >= 5
+    second = sum(ts[:5]) <= 2
+    kept = solver.compile(first)
+    solver.compile(second)
+    solver.release(second)
+    solver.builder.collect()
+    assert solver.compile(first) == kept
+    assert solver.builder.evaluate(kept, {i: i < 5 for i in range(10)})
+    assert not solver.builder.evaluate(kept, {i: i < 4 for i in range(10)})
+
+
+@given(
+    st.lists(st.integers(-5, 5).filter(bool), min_size=2, max_size=8),
+    st.integers(-10, 10))
+def test_reordering_while_compiling_keeps_results_correct(ls, m):
+    solver = Solver(reorder_threshold=8)
+    xs = [variable(i) for i in range(len(ls))]
+    ys = [variable(len(ls) + i) for i in range(len(ls))]
+    objective = sum(l * x for l, x in zip(ls, xs))
+    pairs = False
+    for x, y in zip(xs, ys):
+        pairs = pairs | (x & y)
+    constraint = (objective != m) & pairs
+    try:
+        assignment = solver.solve(constraint)
+    except Unsatisfiable:
+        assume(False)
+    for i in range(2 * len(ls)):
+        assignment.setdefault(i, False)
+    assert constraint.evaluate(assignment)